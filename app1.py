@@ -1,226 +1,206 @@
 import streamlit as st
-import json
 import base64
-import time
-import os
-from openai import OpenAI
+import html
+import orjson
+from core import (
+    BATCH_MODEL,
+    OPENROUTER_API_KEY,
+    VISION_MODEL,
+    batch_api_toggle,
+    encoded_uploads,
+    partial_items,
+    run_uploads,
+    static_image_url,
+    to_json,
+)
 
 # ================= CONFIG =================
 
-OPENROUTER_API_KEY = st.secrets.get("OPENROUTER_API_KEY") or os.environ.get("OPENROUTER_API_KEY")
-
 if not OPENROUTER_API_KEY:
     st.error("API key missing. Please set OPENROUTER_API_KEY in Streamlit secrets.")
     st.stop()
 
-client = OpenAI(
-    base_url="https://openrouter.ai/api/v1",
-    api_key=OPENROUTER_API_KEY,
-    default_headers={
-        "HTTP-Referer": "https://ai-outfit-fitcheck.streamlit.app",
-        "X-Title": "AI Outfit Fitcheck"
-    }
-)
-
-VISION_MODEL = "allenai/molmo-2-8b:free"
-TEXT_MODEL = "allenai/molmo-2-8b:free"
-
 # ================= UI =================
 
 st.set_page_config(page_title="AI Outfit Fitcheck", layout="centered")
 
-st.markdown("""
-<style>
-.block-container { max-width: 420px; }
-
-.image-wrap { position: relative; width:100%; }
-.overlay {
-    position:absolute;
-    top:12px;
-    left:12px;
-    display:flex;
-    flex-wrap:wrap;
-    gap:8px;
-}
-.tag {
-    padding:6px 12px;
-    border-radius:999px;
-    font-size:12px;
-    font-weight:600;
-    box-shadow:0 4px 10px rgba(0,0,0,.2);
-}
-.good { background:#d1fae5; color:#065f46; }
-.bad { background:#fee2e2; color:#991b1b; }
-img { border-radius:16px; }
-</style>
-""", unsafe_allow_html=True)
+# Minified once into a single constant; it has to be sent on every rerun,
+# since Streamlit drops any element a rerun does not emit again
+APP_CSS = (
+    "<style>"
+    ".block-container{max-width:420px}"
+    ".image-wrap{position:relative;width:100%}"
+    ".live-tags{display:flex;flex-wrap:wrap;gap:8px;margin-bottom:8px}"
+    ".overlay{position:absolute;top:12px;left:12px;display:flex;flex-wrap:wrap;gap:8px}"
+    ".tag{padding:6px 12px;border-radius:999px;font-size:12px;font-weight:600;"
+    "box-shadow:0 4px 10px rgba(0,0,0,.2)}"
+    ".good{background:#d1fae5;color:#065f46}"
+    ".bad{background:#fee2e2;color:#991b1b}"
+    ".tip{background:#fef3c7;color:#92400e}"
+    ".note{padding:12px 16px;border-radius:8px;margin-bottom:8px}"
+    "img{border-radius:16px}"
+    "</style>"
+)
+
+st.markdown(APP_CSS, unsafe_allow_html=True)
 
 st.title("🧥 AI Outfit Fitcheck")
 st.caption("Upload an outfit photo and get a structured analysis")
 
-uploaded_file = st.file_uploader("Upload outfit image", type=["jpg","jpeg","png"])
-
-if uploaded_file:
-    st.image(uploaded_file, caption="Uploaded preview", use_container_width=True)
-
-# ================= PROMPTS =================
-
-VISION_PROMPT = """
-Describe ONLY what is visible in the image.
-- Clothing items only
-- No opinions
-- No guessing
-- Short factual sentences
-"""
-
-TEXT_PROMPT = """
-Return ONLY valid JSON in this exact schema:
-
-{
-  "overall_vibe": {"summary": "", "category": ""},
-  "what_works": [],
-  "what_needs_work": [],
-  "suggestions": [],
-  "item_flags": {"dress": "", "top": "", "bottom": "", "shoes": "", "bag": "", "accessories": ""}
-}
-"""
-
-# ================= HELPERS =================
-
-def extract_json(text):
-    start = text.find("{")
-    end = text.rfind("}") + 1
-    if start == -1:
-        return None
-    try:
-        return json.loads(text[start:end])
-    except:
-        return None
-
-def normalize(data):
-    data["what_works"] = data.get("what_works", [])[:3]
-    data["what_needs_work"] = data.get("what_needs_work", [])[:2]
-    data["suggestions"] = data.get("suggestions", [])[:2]
-
-    while len(data["what_works"]) < 3:
-        data["what_works"].append("Outfit elements appear visually consistent.")
-
-    while len(data["what_needs_work"]) < 2:
-        data["what_needs_work"].append("No clearly visible fit issues are present.")
+uploaded_files = st.file_uploader(
+    "Upload outfit images", type=["jpg","jpeg","png"], accept_multiple_files=True
+)
 
-    while len(data["suggestions"]) < 2:
-        data["suggestions"].append("No visible changes required.")
+uploaded_files, images = encoded_uploads(uploaded_files)
 
-    return data
+# Previews show the downscaled JPEG that is sent to the model, not the original
+for f, (_, image_b64, _) in zip(uploaded_files, images):
+    st.image(base64.b64decode(image_b64), caption=f"Uploaded preview · {f.name}", use_container_width=True)
 
 # ================= UI BLOCKS =================
 
-def render_overlay(image, result):
-    good = result["what_works"][:2]
-    bad = result["what_needs_work"][:2]
-
-    chips = ""
-    for g in good:
-        chips += f'<div class="tag good">✓ {g}</div>'
-    for b in bad:
-        chips += f'<div class="tag bad">✕ {b}</div>'
-
-    st.markdown(f"""
-    <div class="image-wrap">
-        <img src="data:image/jpeg;base64,{base64.b64encode(image.getvalue()).decode()}" style="width:100%">
-        <div class="overlay">{chips}</div>
-    </div>
-    """, unsafe_allow_html=True)
+# HTML templates, parsed once at import and filled with str.format
+OVERLAY_TEMPLATE = (
+    '<div class="image-wrap">'
+    '<img src="{src}" style="width:100%">'
+    '<div class="overlay">{chips}</div>'
+    '</div>'
+)
+LIVE_TEMPLATE = '<div class="live-tags">{chips}</div>'
+GOOD_CHIP = '<div class="tag good">✓ {}</div>'
+BAD_CHIP = '<div class="tag bad">✕ {}</div>'
+NOTE_TEMPLATE = '<div class="note {kind}">{text}</div>'
+
+def chips_html(good, bad):
+    # Model text is escaped so stray markup cannot break the overlay layout
+    return "".join(GOOD_CHIP.format(html.escape(g)) for g in good) + "".join(
+        BAD_CHIP.format(html.escape(b)) for b in bad
+    )
+
+# Render helpers are cached on small hashable keys, so a result that comes
+# back from the cache again skips rebuilding its HTML
+
+@st.cache_data(show_spinner=False)
+def overlay_html(src, good, bad):
+    return OVERLAY_TEMPLATE.format(src=src, chips=chips_html(good, bad))
+
+def render_overlay(run):
+    result = run["result"]
+    st.markdown(
+        overlay_html(
+            # A static URL instead of an inline data URI keeps the page HTML small
+            static_image_url(run["image_sha"], run["image_b64"]),
+            tuple(result["what_works"][:2]),
+            tuple(result["what_needs_work"][:2]),
+        ),
+        unsafe_allow_html=True,
+    )
+
+def draw_live(box, text):
+    # Chips appear as each finding closes in the stream; the final render replaces them
+    good = partial_items(text, "what_works")[:2]
+    bad = partial_items(text, "what_needs_work")[:2]
+    if not good and not bad:
+        box.caption("Reading the outfit...")
+        return
+    box.markdown(LIVE_TEMPLATE.format(chips=chips_html(good, bad)), unsafe_allow_html=True)
+
+def render_gallery(runs):
+    cols = st.columns(3)
+    for i, run in enumerate(runs):
+        with cols[i % 3]:
+            st.image(base64.b64decode(run["image_b64"]), use_container_width=True)
+            if run["result"]:
+                vibe = run["result"]["overall_vibe"]
+                st.caption(f"**{vibe['summary']}**  \n{vibe['category']}")
+            else:
+                st.caption("No analysis")
+
+def notes_html(items, kind):
+    return "".join([NOTE_TEMPLATE.format(kind=kind, text=html.escape(i)) for i in items])
+
+@st.cache_data(show_spinner=False)
+def render_analysis(data_json):
+    # Takes the serialized result as its key; Streamlit replays the elements on a hit
+    data = orjson.loads(data_json)
 
-def render_analysis(data):
     st.divider()
     st.markdown("## Outfit Analysis")
 
     st.info(f"**{data['overall_vibe']['summary']}**  \nCategory: {data['overall_vibe']['category']}")
 
+    # One markdown message per section instead of one per item
     st.markdown("### ✅ What works")
-    for i in data["what_works"]:
-        st.success(i)
+    st.markdown(notes_html(data["what_works"], "good"), unsafe_allow_html=True)
 
     st.markdown("### ❌ What needs work")
-    for i in data["what_needs_work"]:
-        st.error(i)
+    st.markdown(notes_html(data["what_needs_work"], "bad"), unsafe_allow_html=True)
 
     st.markdown("### 💡 Suggestions")
-    for i in data["suggestions"]:
-        st.warning(i)
+    st.markdown(notes_html(data["suggestions"], "tip"), unsafe_allow_html=True)
 
 # ================= RUN =================
 
-if uploaded_file and st.button("Analyze outfit"):
-
-    with st.spinner("Analyzing image..."):
-
-        total_start = time.time()
-        image_b64 = base64.b64encode(uploaded_file.read()).decode()
-
-        # Vision
-        t1 = time.time()
-        vision = client.chat.completions.create(
-            model=VISION_MODEL,
-            temperature=0,
-            max_tokens=400,
-            messages=[
-                {"role":"system","content":VISION_PROMPT},
-                {"role":"user","content":[
-                    {"type":"text","text":"Describe the visible outfit."},
-                    {"type":"image_url","image_url":{"url":f"data:image/jpeg;base64,{image_b64}"}}
-                ]}
-            ],
-        )
-        vision_time = time.time() - t1
-
-        vtext = vision.choices[0].message.content or ""
-        vjson = extract_json(vtext)
-
-        # Structuring
-        t2 = time.time()
-        tinput = json.dumps(vjson) if vjson else vtext
-        text = client.chat.completions.create(
-            model=TEXT_MODEL,
-            temperature=0,
-            max_tokens=600,
-            messages=[
-                {"role":"system","content":TEXT_PROMPT},
-                {"role":"user","content":tinput}
-            ],
-        )
-        text_time = time.time() - t2
-
-        total_time = time.time() - total_start
-
-        ftext = text.choices[0].message.content or ""
-        fjson = extract_json(ftext)
-
-        if not fjson:
-            st.error("Failed to generate valid JSON")
-            st.code(ftext)
-            st.stop()
+use_batch_api = batch_api_toggle(len(uploaded_files))
+
+# Live token view per image, cleared once the final analysis renders
+outcome = run_uploads(
+    images,
+    use_batch_api,
+    lambda: [st.empty() for _ in uploaded_files],
+    draw_live,
+    run_label="Analyze outfit",
+    rerun_label="Re-analyze",
+    rerun_help="Ignore saved results and ask the model again",
+)
+
+if outcome:
+    runs, _ = outcome
+
+    if len(uploaded_files) > 1:
+        st.divider()
+        st.markdown("## Gallery")
+        render_gallery(runs)
+
+    for file, run in zip(uploaded_files, runs):
+
+        if len(uploaded_files) > 1:
+            st.divider()
+            st.markdown(f"## {file.name}")
+
+        result = run["result"]
 
-        result = normalize(fjson)
+        if run.get("error"):
+            st.error(run["error"])
+            continue
+
+        if not result:
+            st.error("Failed to generate valid JSON")
+            st.code(run["raw"])
+            continue
 
         # UI
-        render_overlay(uploaded_file, result)
-        render_analysis(result)
+        result_json = to_json(result)
+        render_overlay(run)
+        render_analysis(result_json)
 
         st.divider()
         st.subheader("Raw JSON output")
-        st.code(json.dumps(result, indent=2), language="json")
+        st.code(result_json, language="json")
+
+        model = BATCH_MODEL if use_batch_api else VISION_MODEL
+        prompt_cache = (run["usage"].get("prompt_tokens_details") or {}).get("cached_tokens", 0)
 
         st.divider()
         st.subheader("System notes")
         st.markdown(f"""
 Deterministic: temperature=0  
-Vision time: {vision_time:.2f}s  
-Structuring time: {text_time:.2f}s  
-Total time: {total_time:.2f}s (target ≤ 3s p95)  
-
-Model: allenai/molmo-2-8b  
-Calls per request: 2  
-Approx cost: free tier  
+Structured output: JSON schema (single vision call)  
+Total time: {run["latency"]:.2f}s (target ≤ 3s p95)  
+
+Model: {model}  
+Calls per request: 1 ({"served from cache" if not run["api_calls"] else "sent"})  
+Prompt cache: {prompt_cache}/{run["usage"].get("prompt_tokens", "n/a")} prompt tokens cached  
+Images in batch: {len(uploaded_files)} ({"one Batch API job" if use_batch_api else "analyzed concurrently"})  
+Approx cost: {"free tier" if model.endswith(":free") else "billed per token"}  
 """)
@@ -0,0 +1,1125 @@
+import streamlit as st
+import json
+import base64
+import time
+import os
+import asyncio
+import hashlib
+import httpx
+import io
+import math
+import re
+import sqlite3
+import threading
+import orjson
+from collections import OrderedDict
+from concurrent.futures import wait
+from contextlib import closing
+from functools import partial
+from json_repair import repair_json
+from openai import APIError, AsyncOpenAI
+from PIL import Image, ImageOps
+from pydantic import BaseModel, ConfigDict, Field, ValidationError
+from typing import List, Literal
+
+# Shared by app.py and app1.py: both pages import this module once per
+# process, so the clients, caches and prompts exist only once.
+
+# ================= CONFIG =================
+# Load API key from Streamlit secrets (environment variable for deployment).
+# Each page checks it and stops with its own message when it is missing.
+OPENROUTER_API_KEY = st.secrets.get("OPENROUTER_API_KEY") or os.environ.get("OPENROUTER_API_KEY")
+
+
+def start_loop() -> asyncio.AbstractEventLoop:
+    """One long-lived event loop, so the async clients keep their pools."""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="fitcheck-loop", daemon=True).start()
+    return loop
+
+
+OPENROUTER_URL = "https://openrouter.ai/api/v1"
+
+# Same policy as the OpenAI SDK default: two retries on transient failures
+MAX_RETRIES = 2
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+
+# What a failed run can raise: stream errors, HTTP/transport failures, Batch API
+# errors and SQLite cache errors (e.g. "database is locked" under concurrent writes)
+PIPELINE_ERRORS = (RuntimeError, httpx.HTTPError, APIError, sqlite3.Error)
+
+
+def new_http_client() -> httpx.AsyncClient:
+    """Pooled HTTP/2 client for OpenRouter, used only from the shared loop.
+
+    Concurrent image requests multiplex over one TLS connection, and idle
+    connections are kept for a minute so back-to-back runs skip the handshake.
+    """
+    return httpx.AsyncClient(
+        http2=True,
+        base_url=OPENROUTER_URL,
+        headers={
+            "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+            "HTTP-Referer": "https://ai-outfit-fitcheck.streamlit.app",
+            "X-Title": "AI Outfit Fitcheck",
+            "Content-Type": "application/json",
+        },
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50, keepalive_expiry=60.0),
+        timeout=httpx.Timeout(120.0, connect=10.0),
+    )
+
+
+# SINGLE VISION CALL EMITS THE FINAL JSON. A 3B VLM is enough to list visible
+# garments and answers faster than the 8B default it replaces; set VISION_MODEL
+# (e.g. "allenai/molmo-2-8b:free") to pick another model after checking that
+# it still fills the schema on a few held-out photos.
+VISION_MODEL = (
+    st.secrets.get("VISION_MODEL")
+    or os.environ.get("VISION_MODEL")
+    or "qwen/qwen2.5-vl-3b-instruct"
+)
+
+# Uploads are downscaled to this longest side before encoding
+MAX_IMAGE_SIDE = 1024
+
+# Responses are cached on disk, keyed by a hash of the full request payload,
+# with the most recent ones also held in memory (memory → disk → network)
+CACHE_PATH = os.path.join(".llm_cache", "fitcheck.sqlite3")
+MEM_CACHE_SIZE = 64
+
+# Near-duplicate photos (same outfit, almost the same pose) reuse a stored result
+NEAR_DUP_MAX_DISTANCE = 4  # differing bits out of 768 (256 per colour channel)
+NEAR_DUP_TTL = 7 * 24 * 3600
+
+# Optional OpenAI-compatible Batch API for multi-image uploads (OpenRouter has no /batches)
+BATCH_API_KEY = st.secrets.get("BATCH_API_KEY") or os.environ.get("BATCH_API_KEY")
+BATCH_MODEL = "gpt-4o-mini"
+# Jobs are polled in short steps across reruns, and given up on after BATCH_MAX_WAIT
+BATCH_POLL_INTERVAL = 15
+BATCH_MAX_WAIT = 6 * 3600
+
+def new_batch_client():
+    if not BATCH_API_KEY:
+        return None
+    # HTTP/2 keep-alive pool: upload, create and every status poll share one connection
+    return AsyncOpenAI(
+        base_url="https://api.openai.com/v1",
+        api_key=BATCH_API_KEY,
+        max_retries=MAX_RETRIES,
+        http_client=httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=20, keepalive_expiry=60.0),
+            timeout=60.0,
+        ),
+    )
+
+
+@st.cache_resource
+def get_runtime() -> dict:
+    """The loop and the async clients bound to it, cached as one resource.
+
+    A client's connection pool belongs to the loop it first ran on, so
+    clearing the cache has to replace all three together; callers look
+    them up here at call time instead of holding them from import.
+    """
+    return {
+        "loop": start_loop(),
+        "http": new_http_client() if OPENROUTER_API_KEY else None,
+        "batch": new_batch_client(),
+    }
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    return get_runtime()["loop"]
+
+
+def get_http() -> httpx.AsyncClient:
+    return get_runtime()["http"]
+
+
+def get_batch_client():
+    return get_runtime()["batch"]
+
+# Downscaled uploads are served from here (server.enableStaticServing) so
+# pages reference them by URL instead of inlining base64 into the HTML
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+STATIC_MAX_FILES = 200
+# The folder is public, so file names are keyed with a per-process secret:
+# knowing a photo's content hash is not enough to fetch it
+STATIC_KEY = os.urandom(32)
+
+# Output budget: the final JSON stays well under ~250 tokens. Re-check against
+# token_ceiling() after representative runs before lowering it further.
+MAX_TOKENS = 300
+# Stops a model that keeps rambling in prose after the JSON
+STOP_SEQUENCES = ["\n\n\n"]
+
+# ================= PROMPTS =================
+
+# Kept terse: every token here is prefilled on every call
+FITCHECK_PROMPT = """Fitcheck the visible clothing only; no guessing. Output ONLY this JSON:
+{"overall_vibe":{"summary":"","category":""},"what_works":[],"what_needs_work":[],"suggestions":[],"item_flags":{"dress":"","top":"","bottom":"","shoes":"","bag":"","accessories":""}}
+Lists hold 3/2/2 short factual sentences (color, garment, obvious fit). item_flags: "visible" or "not_detected"; never evaluate not_detected items."""
+
+# (section, exact count, filler) — shared by the schema and sanitize_final
+SECTION_LIMITS = (
+    ("what_works", 3, "Visible clothing items form a consistent appearance."),
+    ("what_needs_work", 2, "No clearly visible fit issues are present."),
+    ("suggestions", 2, "No changes are required based on visible elements."),
+)
+
+# (section, exact count, full-length filler tuple); padding is one slice + extend
+SECTION_PADS = tuple(
+    (section, limit, (filler,) * limit) for section, limit, filler in SECTION_LIMITS
+)
+
+# The response shape as Pydantic models: they generate the strict JSON schema
+# sent as response_format and validate responses in one Rust-backed pass
+SECTION_MAX = {section: limit for section, limit, _ in SECTION_LIMITS}
+Flag = Literal["visible", "not_detected"]
+
+
+class Vibe(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    summary: str
+    category: str
+
+
+class ItemFlags(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    dress: Flag
+    top: Flag
+    bottom: Flag
+    shoes: Flag
+    bag: Flag
+    accessories: Flag
+
+
+class Fitcheck(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    overall_vibe: Vibe
+    what_works: List[str] = Field(max_length=SECTION_MAX["what_works"])
+    what_needs_work: List[str] = Field(max_length=SECTION_MAX["what_needs_work"])
+    suggestions: List[str] = Field(max_length=SECTION_MAX["suggestions"])
+    item_flags: ItemFlags
+
+
+ITEM_FLAG_KEYS = list(ItemFlags.model_fields)
+# Whole-word item mentions (plurals too), so "dressy" or "baggy" do not count
+ITEM_MENTION_RE = re.compile(
+    r"\b(" + "|".join(ITEM_FLAG_KEYS) + r")(?:e?s)?\b", re.IGNORECASE
+)
+
+# Constrains the model to emit the final shape directly (OpenAI-style structured output)
+FITCHECK_SCHEMA = {"name": "fitcheck", "strict": True, "schema": Fitcheck.model_json_schema()}
+
+# Static parts of every request, serialized once at import; orjson splices a
+# Fragment into each body verbatim, so only the image entry is encoded per call.
+# The system prompt is marked cacheable so providers that support prompt caching
+# (Anthropic cache_control, OpenAI prefix caching via OpenRouter) bill it once.
+SYSTEM_MESSAGE = orjson.Fragment(orjson.dumps({
+    "role": "system",
+    "content": [
+        {"type": "text", "text": FITCHECK_PROMPT, "cache_control": {"type": "ephemeral"}}
+    ],
+}))
+# api.openai.com caches prefixes automatically and does not take cache_control
+BATCH_SYSTEM_MESSAGE = orjson.Fragment(
+    orjson.dumps({"role": "system", "content": FITCHECK_PROMPT})
+)
+USER_TEXT = orjson.Fragment(orjson.dumps({"type": "text", "text": "Fitcheck the visible outfit."}))
+RESPONSE_FORMAT = orjson.Fragment(
+    orjson.dumps({"type": "json_schema", "json_schema": FITCHECK_SCHEMA})
+)
+JSON_OBJECT_FORMAT = orjson.Fragment(b'{"type":"json_object"}')
+
+# ================= HELPERS =================
+
+def first_json_object(text: str):
+    """Return the first balanced {...} span in one pass, ignoring braces inside strings."""
+    depth, start = 0, -1
+    in_str = esc = False
+    for i, c in enumerate(text):
+        if in_str:
+            if esc:
+                esc = False
+            elif c == "\\":
+                esc = True
+            elif c == '"':
+                in_str = False
+        elif c == '"':
+            in_str = depth > 0
+        elif c == "{":
+            if not depth:
+                start = i
+            depth += 1
+        elif c == "}" and depth:
+            depth -= 1
+            if not depth:
+                return text[start:i + 1]
+    return None
+
+
+def to_json(obj) -> str:
+    """Pretty-print for display; orjson keeps non-ASCII text readable."""
+    return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+
+
+def parse_fitcheck(text: str):
+    """Validate schema-constrained output directly; loose extraction is the fallback."""
+    try:
+        return Fitcheck.model_validate_json(text).model_dump()
+    except ValidationError:
+        return extract_json_loose(text)
+
+
+def has_fitcheck_shape(data) -> bool:
+    """True when the parsed object/list layout matches Fitcheck; only such responses are cached.
+
+    The loose and repair fallbacks accept any dict, e.g. a flattened
+    "overall_vibe": "Casual"; sanitize_final still renders those.
+    """
+    return (
+        isinstance(data, dict)
+        and isinstance(data.get("overall_vibe"), dict)
+        and isinstance(data.get("item_flags"), dict)
+        and all(isinstance(data.get(section), list) for section in SECTION_MAX)
+    )
+
+
+def extract_json_loose(text: str):
+    """Extract JSON if present, otherwise return None."""
+    # Schema-constrained output is usually the bare object: one C-level parse, no scan
+    try:
+        data = orjson.loads(text)
+    except orjson.JSONDecodeError:
+        pass
+    else:
+        if isinstance(data, dict):
+            return data
+
+    span = first_json_object(text)
+    if span is None:
+        # No balanced object: the output was cut off; repair from the first brace
+        start = text.find("{")
+        return repair_object(text[start:]) if start >= 0 else None
+    try:
+        return orjson.loads(span)
+    except orjson.JSONDecodeError:
+        pass
+    # orjson rejects a few things the stdlib accepts (NaN, Infinity, huge ints)
+    try:
+        return json.loads(span)
+    except ValueError:
+        return repair_object(span)
+
+
+def repair_object(text: str):
+    """Coerce near-valid JSON (trailing commas, comments, unclosed brackets) into a dict.
+
+    Fixing the output locally is far cheaper than another model call.
+    """
+    try:
+        data = repair_json(text, return_objects=True)
+    except Exception:
+        return None
+    return data if isinstance(data, dict) and data else None
+
+
+# Locate array items that have fully arrived in a JSON object still being streamed
+PARTIAL_SECTION_RE = {
+    section: re.compile(rf'"{section}"\s*:\s*\[') for section, _, _ in SECTION_LIMITS
+}
+PARTIAL_ITEM_RE = re.compile(r'\s*"((?:[^"\\]|\\.)*)"\s*([,\]])?')
+
+
+def partial_items(text: str, section: str) -> list:
+    """Return the completed string items of `section` from a partial JSON buffer."""
+    match = PARTIAL_SECTION_RE[section].search(text)
+    if match is None:
+        return []
+    items, pos = [], match.end()
+    while (item := PARTIAL_ITEM_RE.match(text, pos)) is not None:
+        try:
+            items.append(orjson.loads(f'"{item.group(1)}"'))
+        except orjson.JSONDecodeError:
+            break
+        if item.group(2) != ",":
+            break
+        pos = item.end()
+    return items
+
+
+def prepare_image(image_bytes: bytes) -> bytes:
+    """Cap the longest side and re-encode as JPEG; the model resizes internally anyway."""
+    # Apply the EXIF orientation first; phone photos are often stored sideways
+    img = ImageOps.exif_transpose(Image.open(io.BytesIO(image_bytes)))
+    img.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE), Image.LANCZOS)
+    buf = io.BytesIO()
+    img.convert("RGB").save(buf, "JPEG", quality=85, optimize=True)
+    return buf.getvalue()
+
+
+def dhash(image_bytes: bytes, size: int = 16) -> int:
+    """Difference hash per colour channel (R, G, B concatenated).
+
+    A grayscale hash barely changes between a red and a green shirt; hashing
+    each channel makes colour changes show up as many differing bits.
+    """
+    img = Image.open(io.BytesIO(image_bytes)).convert("RGB").resize((size + 1, size), Image.LANCZOS)
+    px = img.tobytes()  # interleaved R, G, B
+    bits = 0
+    for channel in range(3):
+        for row in range(size):
+            for col in range(size):
+                i = (row * (size + 1) + col) * 3 + channel
+                bits = (bits << 1) | (px[i] > px[i + 3])
+    return bits
+
+
+# Bounded: each entry holds a base64 JPEG, and the per-session store in
+# encoded_uploads already covers reruns; this only spans sessions
+@st.cache_data(show_spinner=False, max_entries=64)
+def encode_image(raw: bytes) -> tuple:
+    """Downscale, hash, fingerprint and base64 an upload once."""
+    image_bytes = prepare_image(raw)
+    return (
+        hashlib.sha256(image_bytes).hexdigest(),
+        base64.b64encode(image_bytes).decode(),
+        dhash(image_bytes),
+    )
+
+
+def is_sentence(s: str) -> bool:
+    """Basic sentence-quality filter."""
+    return len(s.split()) >= 4
+
+
+def sanitize_final(result: dict) -> dict:
+    """Final hard guardrails, shared by every page."""
+
+    # Normalize item_flags; missing keys (or a non-object) count as not detected
+    flags = result.get("item_flags")
+    flags = flags if isinstance(flags, dict) else {}
+    item_flags = {
+        k: "visible" if flags.get(k) == "visible" else "not_detected"
+        for k in ITEM_FLAG_KEYS
+    }
+    result["item_flags"] = item_flags
+    vibe = result.get("overall_vibe")
+    if isinstance(vibe, str):
+        vibe = {"summary": vibe}  # small models sometimes flatten it to the summary
+    vibe = vibe if isinstance(vibe, dict) else {}
+    result["overall_vibe"] = {
+        "summary": str(vibe.get("summary", "")),
+        "category": str(vibe.get("category", "")),
+    }
+
+    # Remove references to not_detected items and non-sentences, then
+    # enforce counts and pad; each section stops scanning once it is full
+    not_detected = {k for k, status in item_flags.items() if status == "not_detected"}
+    for section, limit, pad in SECTION_PADS:
+        kept = []
+        items = result.get(section)
+        for s in items if isinstance(items, list) else ():
+            if not isinstance(s, str) or not is_sentence(s):
+                continue
+            if any(m.lower() in not_detected for m in ITEM_MENTION_RE.findall(s)):
+                continue
+            kept.append(s)
+            if len(kept) == limit:
+                break
+        kept.extend(pad[len(kept):])
+        result[section] = kept
+
+    return result
+
+# ================= TRANSPORT =================
+
+async def sse_deltas(resp, usage=None):
+    """Yield content deltas from an OpenAI-style server-sent event stream.
+
+    Token usage, when the provider reports it, is copied into `usage`.
+    """
+    async for line in resp.aiter_lines():
+        if not line.startswith("data:"):
+            continue  # blank separators and ": keep-alive" comments
+        payload = line[5:].strip()
+        if payload == "[DONE]":
+            return
+        try:
+            chunk = orjson.loads(payload)
+        except orjson.JSONDecodeError as e:
+            raise RuntimeError(f"Malformed stream event: {payload[:200]}") from e
+        if not isinstance(chunk, dict):
+            raise RuntimeError(f"Unexpected stream event: {payload[:200]}")
+        if "error" in chunk:
+            error = chunk["error"]
+            raise RuntimeError(
+                error.get("message", "Stream error") if isinstance(error, dict) else str(error)
+            )
+        if usage is not None and isinstance(chunk.get("usage"), dict):
+            usage.update(chunk["usage"])
+        choices = chunk.get("choices") or [{}]
+        yield (choices[0].get("delta") or {}).get("content") or ""
+
+
+async def read_stream(deltas, on_text=None) -> str:
+    """Accumulate streamed deltas up to the end of the first JSON object.
+
+    Anything the model emits after the closing brace is filler and is
+    dropped, but the stream is still drained: the usage chunk only arrives
+    at the end, and max_tokens/stop bound how much filler there can be.
+    """
+    buffer = ""
+    depth, in_str, esc, closed = 0, False, False, False
+
+    async for delta in deltas:
+        if closed:
+            continue
+        end = None
+        for i, c in enumerate(delta):
+            if in_str:
+                if esc:
+                    esc = False
+                elif c == "\\":
+                    esc = True
+                elif c == '"':
+                    in_str = False
+            elif c == '"' and depth:
+                in_str = True
+            elif c == "{":
+                depth += 1
+            elif c == "}" and depth:
+                depth -= 1
+                if not depth:
+                    end = i + 1
+                    break
+
+        buffer += delta[:end]
+        if on_text is not None and delta:
+            on_text(buffer)
+        closed = end is not None
+
+    return buffer
+
+
+async def stream_chat(body: dict, on_text=None, usage=None) -> str:
+    """POST a streamed chat completion straight to OpenRouter, bypassing the SDK.
+
+    Rate limits, 5xx responses and dropped connections are retried with
+    backoff, like the SDK's max_retries.
+    """
+    data = orjson.dumps({**body, "stream": True, "stream_options": {"include_usage": True}})
+    for attempt in range(MAX_RETRIES + 1):
+        retry = attempt < MAX_RETRIES
+        try:
+            async with get_http().stream("POST", "/chat/completions", content=data) as resp:
+                if resp.status_code in RETRY_STATUSES and retry:
+                    await asyncio.sleep(0.5 * 2 ** attempt)
+                    continue
+                if resp.status_code >= 400:
+                    await resp.aread()
+                    raise httpx.HTTPStatusError(
+                        f"OpenRouter returned {resp.status_code}: {resp.text}",
+                        request=resp.request,
+                        response=resp,
+                    )
+                return await read_stream(sse_deltas(resp, usage), on_text)
+        except httpx.TransportError:
+            if not retry:
+                raise
+            await asyncio.sleep(0.5 * 2 ** attempt)
+
+# ================= CACHE =================
+
+@st.cache_resource
+def init_cache() -> str:
+    """Create the on-disk response cache once per process."""
+    os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+    with closing(sqlite3.connect(CACHE_PATH)) as conn, conn:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS near_dup ("
+            "scope TEXT NOT NULL, fingerprint TEXT NOT NULL, value TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS near_dup_scope ON near_dup (scope, created)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS batch_jobs ("
+            "job TEXT PRIMARY KEY, batch_id TEXT NOT NULL, created REAL NOT NULL)"
+        )
+    return CACHE_PATH
+
+
+# In-process LRU tier; read from the loop and from worker threads, hence the lock
+mem_cache = OrderedDict()
+mem_lock = threading.Lock()
+
+
+def mem_get(key: str):
+    with mem_lock:
+        value = mem_cache.get(key)
+        if value is not None:
+            mem_cache.move_to_end(key)
+    return value
+
+
+def mem_put(key: str, value: str) -> None:
+    with mem_lock:
+        mem_cache[key] = value
+        mem_cache.move_to_end(key)
+        if len(mem_cache) > MEM_CACHE_SIZE:
+            mem_cache.popitem(last=False)
+
+
+def cache_get(key: str):
+    value = mem_get(key)
+    if value is not None:
+        return value
+    with closing(sqlite3.connect(init_cache())) as conn:
+        row = conn.execute("SELECT value FROM llm_cache WHERE key = ?", (key,)).fetchone()
+    if row:
+        mem_put(key, row[0])
+    return row[0] if row else None
+
+
+def cache_put(key: str, value: str) -> None:
+    mem_put(key, value)
+    with closing(sqlite3.connect(init_cache())) as conn, conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO llm_cache (key, value) VALUES (?, ?)", (key, value)
+        )
+
+
+def similar_get(scope: str, fingerprint: int):
+    """Return content stored for a perceptually near-identical image, if any."""
+    with closing(sqlite3.connect(init_cache())) as conn:
+        rows = conn.execute(
+            "SELECT rowid, fingerprint FROM near_dup WHERE scope = ? AND created > ?",
+            (scope, time.time() - NEAR_DUP_TTL),
+        ).fetchall()
+        best = min(
+            ((bin(int(fp, 16) ^ fingerprint).count("1"), rowid) for rowid, fp in rows),
+            default=None,
+        )
+        if not best or best[0] > NEAR_DUP_MAX_DISTANCE:
+            return None
+        row = conn.execute("SELECT value FROM near_dup WHERE rowid = ?", (best[1],)).fetchone()
+    return row[0] if row else None
+
+
+def similar_put(scope: str, fingerprint: int, value: str) -> None:
+    """Store a fingerprint, replacing its previous row, and drop rows past NEAR_DUP_TTL."""
+    now = time.time()
+    fp = format(fingerprint, "x")
+    with closing(sqlite3.connect(init_cache())) as conn, conn:
+        conn.execute(
+            "DELETE FROM near_dup WHERE created <= ? OR (scope = ? AND fingerprint = ?)",
+            (now - NEAR_DUP_TTL, scope, fp),
+        )
+        conn.execute(
+            "INSERT INTO near_dup (scope, fingerprint, value, created) VALUES (?, ?, ?, ?)",
+            (scope, fp, value, now),
+        )
+
+
+def job_get(job: str):
+    """(batch_id, created) of a submitted Batch API job, kept across reloads and sessions."""
+    with closing(sqlite3.connect(init_cache())) as conn:
+        return conn.execute(
+            "SELECT batch_id, created FROM batch_jobs WHERE job = ?", (job,)
+        ).fetchone()
+
+
+def job_put(job: str, batch_id: str) -> None:
+    with closing(sqlite3.connect(init_cache())) as conn, conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO batch_jobs (job, batch_id, created) VALUES (?, ?, ?)",
+            (job, batch_id, time.time()),
+        )
+
+
+def job_delete(job: str) -> None:
+    with closing(sqlite3.connect(init_cache())) as conn, conn:
+        conn.execute("DELETE FROM batch_jobs WHERE job = ?", (job,))
+
+
+async def cache_lookup(key: str):
+    """Exact-cache read: memory hits return inline, disk I/O runs off the loop."""
+    content = mem_get(key)
+    if content is None:
+        content = await asyncio.to_thread(cache_get, key)
+    return content
+
+
+async def chat_completion(request: dict, on_text=None, usage=None) -> str:
+    """Stream one chat completion and return its content.
+
+    Providers that reject json_schema are retried in plain JSON mode; the
+    prompt carries the schema inline for that case.
+    """
+    try:
+        return await stream_chat(request, on_text, usage)
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code not in (400, 404) or request.get("response_format") is not RESPONSE_FORMAT:
+            raise
+        return await stream_chat(
+            {**request, "response_format": JSON_OBJECT_FORMAT}, on_text, usage
+        )
+
+# ================= PIPELINE =================
+
+def fitcheck_key(image_sha: str, model: str, system_message=SYSTEM_MESSAGE) -> str:
+    """SHA-256 over the full request payload (model, messages, temperature, max_tokens, ...).
+
+    The image is stood in for by its hash, so the base64 body is never rehashed.
+    """
+    request = fitcheck_request(model, image_sha, system_message)
+    return hashlib.sha256(orjson.dumps(request, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+
+def fitcheck_scope(model: str) -> str:
+    """Near-duplicate matches are only valid for the same request apart from the image."""
+    return fitcheck_key("", model)
+
+
+def fitcheck_request(model: str, image_url: str, system_message=SYSTEM_MESSAGE) -> dict:
+    """Chat completion body for one image, shared by the live and batch paths."""
+    return {
+        "model": model,
+        "temperature": 0,
+        "max_tokens": MAX_TOKENS,
+        "stop": STOP_SEQUENCES,
+        "response_format": RESPONSE_FORMAT,
+        "messages": [
+            system_message,
+            {
+                "role": "user",
+                "content": [USER_TEXT, {"type": "image_url", "image_url": {"url": image_url}}]
+            }
+        ],
+    }
+
+
+async def run_fitcheck(image: tuple, on_text=None, refresh=False) -> dict:
+    """Run the single Vision → JSON call for one encoded image, streaming into `on_text`.
+
+    With `refresh`, both response caches are bypassed and the model is called again.
+    """
+    start = time.time()
+
+    image_sha, image_b64, fingerprint = image
+    scope = fitcheck_scope(VISION_MODEL)
+
+    key = fitcheck_key(image_sha, VISION_MODEL)
+
+    # memory → disk → near-duplicate scan → network
+    usage = {}
+    raw = None
+    near_dup = False
+    if not refresh:
+        raw = await cache_lookup(key)
+        if raw is None:
+            raw = await asyncio.to_thread(similar_get, scope, fingerprint)
+            near_dup = raw is not None
+    cached = raw is not None
+    if not cached:
+        raw = await chat_completion(
+            fitcheck_request(VISION_MODEL, f"data:image/jpeg;base64,{image_b64}"),
+            on_text,
+            usage,
+        )
+
+    parsed = parse_fitcheck(raw)
+
+    # Only well-shaped responses are stored, so a truncated or garbled reply is retried next time
+    if not cached and has_fitcheck_shape(parsed):
+        await asyncio.to_thread(cache_put, key, raw)
+        await asyncio.to_thread(similar_put, scope, fingerprint, raw)
+    elif near_dup and has_fitcheck_shape(parsed):
+        # Stored under the exact key too, so repeats of this upload skip the scan
+        await asyncio.to_thread(cache_put, key, raw)
+
+    return {
+        "raw": raw,
+        "image_sha": image_sha,
+        "image_b64": image_b64,
+        "result": sanitize_final(parsed) if parsed else None,
+        "latency": time.time() - start,
+        "api_calls": 0 if cached else 1,
+        "usage": usage,
+    }
+
+
+async def run_batch(images, live, refresh=False) -> list:
+    """Fan out one pipeline per image; the calls overlap on the network.
+
+    Any exception from one image becomes that image's "error" result instead
+    of discarding the results of the images that succeeded.
+    """
+    start = time.time()
+    outcomes = await asyncio.gather(*[
+        run_fitcheck(image, partial(live.__setitem__, i), refresh)
+        for i, image in enumerate(images)
+    ], return_exceptions=True)
+
+    results = []
+    for (image_sha, image_b64, _), outcome in zip(images, outcomes):
+        if isinstance(outcome, Exception):
+            outcome = {
+                "raw": "",
+                "image_sha": image_sha,
+                "image_b64": image_b64,
+                "result": None,
+                "latency": time.time() - start,
+                "api_calls": 1,
+                "usage": {},
+                "error": str(outcome) or type(outcome).__name__,
+            }
+        elif isinstance(outcome, BaseException):
+            raise outcome
+        results.append(outcome)
+    return results
+
+# ================= BATCH API =================
+
+async def submit_batch(bodies: dict) -> str:
+    """Upload {custom_id: request body} as one Batch API job and return its id."""
+    jsonl = b"\n".join(
+        orjson.dumps({
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": body,
+        })
+        for custom_id, body in bodies.items()
+    )
+
+    batch_client = get_batch_client()
+    upload = await batch_client.files.create(
+        file=("fitcheck.jsonl", jsonl), purpose="batch"
+    )
+    batch = await batch_client.batches.create(
+        input_file_id=upload.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    return batch.id
+
+
+async def poll_batch(batch_id: str):
+    """Check a job once: {custom_id: content} when it has finished, None while it runs."""
+    batch_client = get_batch_client()
+    batch = await batch_client.batches.retrieve(batch_id)
+    if batch.status not in ("completed", "failed", "expired", "cancelled"):
+        return None
+
+    if not batch.output_file_id:
+        raise RuntimeError(f"Batch {batch.id} ended with status '{batch.status}'")
+
+    output = await batch_client.files.content(batch.output_file_id)
+
+    contents = {}
+    for line in output.content.splitlines():
+        if not line.strip():
+            continue
+        row = orjson.loads(line)
+        body = (row.get("response") or {}).get("body") or {}
+        choices = body.get("choices") or [{}]
+        contents[row["custom_id"]] = (choices[0].get("message") or {}).get("content") or ""
+    return contents
+
+
+async def run_batch_api(images, refresh=False):
+    """Submit every uncached image as one Batch API job and map results back per image.
+
+    Each call checks the job once and returns None while it is still
+    running; the caller polls again on a later rerun. Jobs are recorded in
+    SQLite under their set of request keys, so a reload or a second click
+    picks up the pending job instead of paying for a duplicate.
+    """
+    start = time.time()
+
+    # Cache reads and writes go through cache_lookup/to_thread so SQLite never blocks the loop
+    keys, bodies, hits = [], {}, {}
+    for image_sha, image_b64, _ in images:
+        key = fitcheck_key(image_sha, BATCH_MODEL, BATCH_SYSTEM_MESSAGE)
+        keys.append(key)
+        if key in bodies or key in hits:
+            continue
+        content = None if refresh else await cache_lookup(key)
+        if content is None:
+            bodies[key] = fitcheck_request(
+                BATCH_MODEL, f"data:image/jpeg;base64,{image_b64}", BATCH_SYSTEM_MESSAGE
+            )
+        else:
+            hits[key] = content
+
+    contents = {}
+    if bodies:
+        job = hashlib.sha256("".join(sorted(bodies)).encode()).hexdigest()
+        pending = await asyncio.to_thread(job_get, job)
+        if pending:
+            batch_id, start = pending
+        else:
+            batch_id = await submit_batch(bodies)
+            await asyncio.to_thread(job_put, job, batch_id)
+
+        try:
+            contents = await poll_batch(batch_id)
+        except RuntimeError:
+            # The job ended without output; transient poll errors keep it for the next check
+            await asyncio.to_thread(job_delete, job)
+            raise
+        if contents is None:
+            if time.time() - start < BATCH_MAX_WAIT:
+                return None
+            await asyncio.to_thread(job_delete, job)
+            await get_batch_client().batches.cancel(batch_id)
+            raise RuntimeError(
+                f"Batch {batch_id} did not finish within {BATCH_MAX_WAIT // 3600}h and was cancelled"
+            )
+        await asyncio.to_thread(job_delete, job)
+
+    for key, content in contents.items():
+        if has_fitcheck_shape(parse_fitcheck(content)):
+            await asyncio.to_thread(cache_put, key, content)
+
+    results, counted = [], set()
+    for key, (image_sha, image_b64, _) in zip(keys, images):
+        raw = contents.get(key, hits.get(key)) or ""
+        parsed = parse_fitcheck(raw)
+        results.append({
+            "raw": raw,
+            "image_sha": image_sha,
+            "image_b64": image_b64,
+            "result": sanitize_final(parsed) if parsed else None,
+            "latency": time.time() - start,
+            "api_calls": int(key in bodies and key not in counted),
+            "usage": {},
+        })
+        counted.add(key)
+    return results
+
+# ================= RUNTIME =================
+
+def draw_raw(box, text: str) -> None:
+    box.code(text, language="json")
+
+
+def stage_label(live) -> str:
+    """Progress label for an st.status block, derived from which streams have started."""
+    streaming = sum(text is not None for text in live)
+    if not streaming:
+        return "Looking at the image…"
+    if len(live) == 1:
+        return "Writing analysis…"
+    return f"Writing analysis… ({streaming}/{len(live)} images streaming)"
+
+
+def run_async(coro, boxes=(), live=(), draw=draw_raw, status=None):
+    """Run `coro` on the shared loop and wait for it.
+
+    Streamed text is written into `live` from the loop thread and drawn
+    into `boxes` here with `draw(box, text)`, since Streamlit elements
+    belong to the script thread. If given, `status` (an st.status block)
+    has its label moved through the pipeline stages.
+    """
+    fut = asyncio.run_coroutine_threadsafe(coro, get_loop())
+    drawn = [None] * len(boxes)
+    label = None
+    while not fut.done():
+        wait([fut], timeout=0.1)
+        for i, box in enumerate(boxes):
+            if live[i] is not None and live[i] != drawn[i]:
+                draw(box, live[i])
+                drawn[i] = live[i]
+        if status is not None and stage_label(live) != label:
+            label = stage_label(live)
+            status.update(label=label)
+    return fut.result()
+
+
+async def encode_all(raws) -> list:
+    """Preprocess uploads in parallel worker threads; a failed decode is returned, not raised."""
+    return await asyncio.gather(
+        *[asyncio.to_thread(encode_image, raw) for raw in raws], return_exceptions=True
+    )
+
+
+def encoded_uploads(files) -> tuple:
+    """(files, images): the readable uploads and their (sha256, base64, dhash).
+
+    Entries are keyed by upload id, so reruns skip even the cache_data lookup,
+    which would rehash the raw bytes; removed uploads are dropped. Files that
+    are not decodable images get an st.error and are left out.
+    """
+    store = st.session_state.get("encoded_images", {})
+    missing = [f for f in files if f.file_id not in store]
+    if missing:
+        encoded = run_async(encode_all([f.getvalue() for f in missing]))
+        store = dict(store)
+        for f, image in zip(missing, encoded):
+            # UnidentifiedImageError and truncated-file errors are both OSErrors
+            if isinstance(image, (OSError, Image.DecompressionBombError)):
+                st.error(f"{f.name} could not be read as an image and was skipped.")
+            elif isinstance(image, BaseException):
+                raise image
+            else:
+                store[f.file_id] = image
+    files = [f for f in files if f.file_id in store]
+    st.session_state["encoded_images"] = {f.file_id: store[f.file_id] for f in files}
+    return files, [store[f.file_id] for f in files]
+
+
+def batch_api_toggle(count: int) -> bool:
+    """Opt-in Batch API checkbox, offered for multi-image uploads when it is configured."""
+    if not (get_batch_client() and count > 1):
+        return False
+    return st.checkbox(
+        f"Use Batch API ({BATCH_MODEL}, ~50% cheaper, may take minutes)",
+        help="Submits all images as one batch job and checks on it every few seconds. "
+        "The job is remembered, so reloading the page does not submit it again.",
+    )
+
+
+@st.fragment(run_every=BATCH_POLL_INTERVAL)
+def poll_later() -> None:
+    """Rerun the page every BATCH_POLL_INTERVAL seconds while a batch job is pending.
+
+    The first call only draws the fragment as part of the page; each timed
+    call after it reruns the app, which checks the job once more.
+    """
+    if st.session_state.pop("poll_armed", False):
+        st.rerun()
+    st.session_state["poll_armed"] = True
+
+
+def run_uploads(images, use_batch_api, make_boxes, draw=draw_raw,
+                run_label="Run Fitcheck", rerun_label="Re-run (bypass cache)", rerun_help=None):
+    """The RUN block shared by both pages: (runs, latency), or None with nothing to show.
+
+    The last analysis is kept per set of images, so reruns from other widgets
+    redraw it without calling the API; the run button retries failed images
+    and the re-run button bypasses every cache. A Batch API job that is
+    still running is checked once per rerun, with poll_later() scheduling
+    the next check, so the page stays responsive while it waits.
+    `make_boxes()` creates one placeholder per image that the live stream is
+    drawn into with `draw(box, text)`.
+    """
+    run_key = (use_batch_api, tuple(image[0] for image in images))
+    stored = bool(images) and st.session_state.get("last_key") == run_key
+    run_clicked = bool(images) and st.button(run_label)
+    refresh = stored and st.button(rerun_label, help=rerun_help)
+    # (run_key, refresh) of a batch job that was still running at the last check
+    pending = st.session_state.get("pending_batch")
+    polling = pending is not None and pending[0] == run_key
+    if not (run_clicked or stored or polling):
+        return None
+
+    boxes = make_boxes()
+    if polling and not refresh:
+        refresh = pending[1]
+    elif stored and not refresh:
+        runs, latency = st.session_state["last_runs"]
+        # The run button retries a stored run that has failed images; the
+        # images that succeeded come straight back from the response cache
+        if not (run_clicked and any(run.get("error") or not run["result"] for run in runs)):
+            return runs, latency
+
+    # The pipeline runs on the background loop; this thread only redraws progress
+    live = [None] * len(images)
+    with st.status("Waiting for batch job…" if use_batch_api else "Analyzing outfit…") as status:
+        start = time.time()
+        try:
+            runs = run_async(
+                run_batch_api(images, refresh) if use_batch_api else run_batch(images, live, refresh),
+                boxes,
+                live,
+                draw,
+                None if use_batch_api else status,
+            )
+        except PIPELINE_ERRORS as e:
+            st.session_state.pop("pending_batch", None)
+            st.session_state.pop("poll_armed", None)
+            status.update(label="Analysis failed", state="error")
+            st.error(str(e))
+            st.stop()
+        if runs is None:
+            st.session_state["pending_batch"] = (run_key, refresh)
+            status.update(label=f"Batch job running… checking again every {BATCH_POLL_INTERVAL}s")
+        else:
+            # Batch results carry the time since the job was submitted
+            latency = max(run["latency"] for run in runs) if use_batch_api else time.time() - start
+            status.update(label=f"Done in {latency:.2f}s", state="complete")
+
+    if runs is None:
+        poll_later()
+        return None
+    st.session_state.pop("pending_batch", None)
+    st.session_state.pop("poll_armed", None)
+    for box in boxes:
+        box.empty()
+    record_usage(runs)
+    st.session_state["last_key"] = run_key
+    st.session_state["last_runs"] = (runs, latency)
+    return runs, latency
+
+# ================= STATIC FILES =================
+
+def static_image_url(image_sha: str, image_b64: str) -> str:
+    """Write the downscaled JPEG to static/ once and return the URL Streamlit serves it at."""
+    name = f"{hashlib.blake2b(image_sha.encode(), key=STATIC_KEY, digest_size=20).hexdigest()}.jpg"
+    path = os.path.join(STATIC_DIR, name)
+    try:
+        os.utime(path)  # mark as recently used
+        return f"app/static/{name}"
+    except FileNotFoundError:
+        pass  # new image, or pruned by another session since it was written
+
+    os.makedirs(STATIC_DIR, exist_ok=True)
+    tmp = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(base64.b64decode(image_b64))
+    os.replace(tmp, path)
+    prune_static()
+    return f"app/static/{name}"
+
+
+def prune_static() -> None:
+    """Drop the least recently used images beyond STATIC_MAX_FILES."""
+    files = []
+    with os.scandir(STATIC_DIR) as entries:
+        for e in entries:
+            if not e.name.endswith(".jpg"):
+                continue
+            try:
+                files.append((e.stat().st_mtime, e.path))
+            except FileNotFoundError:
+                pass  # removed by another session after the scan
+    files.sort()
+    for _, path in files[:-STATIC_MAX_FILES]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+# ================= USAGE =================
+
+def record_usage(results) -> None:
+    """Collect reported completion token counts for this session (script thread only)."""
+    seen = st.session_state.setdefault("completion_tokens", [])
+    seen += [r["usage"]["completion_tokens"] for r in results if r["usage"].get("completion_tokens")]
+
+
+def token_ceiling():
+    """p99 of the observed completion tokens plus 15% headroom, or None before any data."""
+    seen = sorted(st.session_state.get("completion_tokens", ()))
+    if not seen:
+        return None
+    return math.ceil(seen[min(len(seen) - 1, int(len(seen) * 0.99))] * 1.15)